@@ -9,10 +9,84 @@
 """Extractors for https://www.patreon.com/"""
 
 from .common import Extractor, Message
-from .. import text
+from .. import text, exception
 from ..cache import memcache
-import collections
+from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os.path
 import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _penultimate_segment(url):
+    """Return the second to last '/'-separated part of 'url'"""
+    end = url.rfind("/")
+    return url[url.rfind("/", 0, end)+1:end]
+
+
+def _parse_datetime(date_string):
+    """Parse an ISO 8601 timestamp into a naive UTC datetime object"""
+    try:
+        date = datetime.datetime.fromisoformat(date_string)
+    except (AttributeError, TypeError, ValueError):
+        # Python < 3.7 or unexpected format
+        return text.parse_datetime(date_string, "%Y-%m-%dT%H:%M:%S.%f%z")
+    offset = date.utcoffset()
+    if offset is not None:
+        date = date.replace(tzinfo=None) - offset
+    return date
+
+
+URL_CHARS_RE = re.compile(r"^[\x00- ]|[/?#%:\t\n\r]")
+
+
+def _nameext(name, data):
+    """Fill 'data' with the filename and extension of 'name'
+
+    Equivalent to text.nameext_from_url(), but skips URL parsing for
+    plain filename strings without any URL-specific characters.
+    """
+    if not isinstance(name, str) or URL_CHARS_RE.search(name):
+        return text.nameext_from_url(name, data)
+    data["filename"], ext = os.path.splitext(name)
+    data["extension"] = ext[1:].lower()
+    return data
+
+
+SRC_RE = re.compile(r'src="([^"]*)"')
+
+CAMPAIGN_RE = re.compile(r"/campaign/(\d+)")
+
+BOOTSTRAP_RE = re.compile(r"window\.patreon\.bootstrap,\s*")
+
+API_URL_FMT = (
+    "https://www.patreon.com/api/{}"
+
+    "?include=user,images,attachments,user_defined_tags,campaign,poll."
+    "choices,poll.current_user_responses.user,poll.current_user_respon"
+    "ses.choice,poll.current_user_responses.poll,access_rules.tier.nul"
+    "l"
+
+    "&fields[post]=change_visibility_at,comment_count,content,current_"
+    "user_can_delete,current_user_can_view,current_user_has_liked,embe"
+    "d,image,is_paid,like_count,min_cents_pledged_to_view,post_file,pu"
+    "blished_at,patron_count,patreon_url,post_type,pledge_url,thumbnai"
+    "l_url,teaser_text,title,upgrade_url,url,was_posted_by_campaign_ow"
+    "ner"
+    "&fields[user]=image_url,full_name,url"
+    "&fields[campaign]=avatar_photo_url,earnings_visibility,is_nsfw,is"
+    "_monthly,name,url"
+    "&fields[access_rule]=access_rule_type,amount_cents{}"
+
+    "&json-api-use-default-includes=false"
+    "&json-api-version=1.0"
+)
 
 
 class PatreonExtractor(Extractor):
@@ -22,8 +96,17 @@ class PatreonExtractor(Extractor):
     directory_fmt = ("{category}", "{creator[full_name]}")
     filename_fmt = "{id}_{title}_{num:>02}.{extension}"
     archive_fmt = "{id}_{num}"
+    api_headers = {
+        "Referer": root,
+        # includes 'br' if urllib3 is able to decode Brotli responses
+        "Accept-Encoding": ACCEPT_ENCODING,
+    }
     _warning = True
 
+    def __init__(self, match):
+        Extractor.__init__(self, match)
+        self.filename_workers = self.config("filename-workers", 1)
+
     def items(self):
         yield Message.Version, 1
 
@@ -35,51 +118,71 @@ class PatreonExtractor(Extractor):
         for post in self.posts():
             yield Message.Directory, post
 
-            ids = set()
-            post["num"] = 0
+            num = 0
             content = post.get("content")
             postfile = post.get("post_file")
-
-            for image in post["images"]:
+            images = post["images"]
+            if postfile:
+                fileid = _penultimate_segment(postfile["url"])
+            if self.filename_workers > 1:
+                names = self._filenames(images)
+            else:
+                names = None
+
+            post["type"] = "image"
+            for image in images:
                 url = image.get("download_url")
                 if not url:
                     continue
-                ids.add(url.split("/")[-2])
-                name = image.get("file_name") or self._filename(url) or url
-
-                post["num"] += 1
-                post["type"] = "image"
-                yield Message.Url, url, text.nameext_from_url(name, post)
-
-            if postfile and postfile["url"].split("/")[-2] not in ids:
-                post["num"] += 1
+                if postfile and _penultimate_segment(url) == fileid:
+                    postfile = None  # same file as this image
+                name = image.get("file_name")
+                if not name:
+                    if names is None:
+                        name = self._filename(url)
+                    else:
+                        name = names.get(url)
+                    name = name or url
+
+                num += 1
+                post["num"] = num
+                yield Message.Url, url, _nameext(name, post)
+
+            if postfile:
+                num += 1
+                post["num"] = num
                 post["type"] = "postfile"
-                text.nameext_from_url(postfile["name"], post)
+                _nameext(postfile["name"], post)
                 yield Message.Url, postfile["url"], post
 
+            post["type"] = "attachment"
             for attachment in post["attachments"]:
-                post["num"] += 1
-                post["type"] = "attachment"
-                text.nameext_from_url(attachment["name"], post)
+                num += 1
+                post["num"] = num
+                _nameext(attachment["name"], post)
                 yield Message.Url, attachment["url"], post
 
             if content:
-                for url in text.extract_iter(content, 'src="', '"'):
-                    post["num"] += 1
-                    post["type"] = "content"
+                post["type"] = "content"
+                for match in SRC_RE.finditer(content):
+                    url = match.group(1)
+                    num += 1
+                    post["num"] = num
                     yield Message.Url, url, text.nameext_from_url(url, post)
 
     def posts(self):
         """Return all relevant post objects"""
 
     def _pagination(self, url):
-        headers = {"Referer": self.root}
-
         while url:
-            posts = self.request(url, headers=headers).json()
+            response = self.request(url, headers=self.api_headers)
+            if orjson:
+                posts = orjson.loads(response.content)
+            else:
+                posts = response.json()
 
             if "included" in posts:
-                included = self._transform(posts["included"])
+                included = IncludedIndex(posts["included"])
                 for post in posts["data"]:
                     yield self._process(post, included)
 
@@ -93,39 +196,30 @@ class PatreonExtractor(Extractor):
         attr["id"] = text.parse_int(post["id"])
         attr["images"] = self._files(post, included, "images")
         attr["attachments"] = self._files(post, included, "attachments")
-        attr["date"] = text.parse_datetime(
-            attr["published_at"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        attr["date"] = _parse_datetime(attr["published_at"])
         attr["creator"] = self._user(
             post["relationships"]["user"]["links"]["related"])
         return attr
 
-    @staticmethod
-    def _transform(included):
-        """Transform 'included' into an easier to handle format"""
-        result = collections.defaultdict(dict)
-        for inc in included:
-            result[inc["type"]][inc["id"]] = inc["attributes"]
-        return result
-
     @staticmethod
     def _files(post, included, key):
         """Build a list of files"""
         files = post["relationships"].get(key)
         if files and files.get("data"):
             return [
-                included[file["type"]][file["id"]]
+                included[(file["type"], file["id"])]
                 for file in files["data"]
             ]
         return []
 
+    # cached by 'url' only and shared between all extractor instances
     @memcache(keyarg=1)
     def _user(self, url):
         """Fetch user information"""
         user = self.request(url).json()["data"]
         attr = user["attributes"]
         attr["id"] = user["id"]
-        attr["date"] = text.parse_datetime(
-            attr["created"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        attr["date"] = _parse_datetime(attr["created"])
         return attr
 
     def _filename(self, url):
@@ -134,30 +228,40 @@ class PatreonExtractor(Extractor):
         cd = response.headers.get("Content-Disposition")
         return text.extract(cd, 'filename="', '"')[0]
 
+    def _filenames(self, images):
+        """Fetch filenames of all 'images' without 'file_name' in parallel"""
+        urls = [
+            image["download_url"] for image in images
+            if image.get("download_url") and not image.get("file_name")
+        ]
+        if len(urls) <= 1:
+            return {url: self._filename(url) for url in urls}
+        with ThreadPoolExecutor(min(len(urls), self.filename_workers)) as pool:
+            return dict(zip(urls, pool.map(self._filename, urls)))
+
     @staticmethod
     def _build_url(endpoint, query):
-        return (
-            "https://www.patreon.com/api/" + endpoint +
-
-            "?include=user,images,attachments,user_defined_tags,campaign,poll."
-            "choices,poll.current_user_responses.user,poll.current_user_respon"
-            "ses.choice,poll.current_user_responses.poll,access_rules.tier.nul"
-            "l"
-
-            "&fields[post]=change_visibility_at,comment_count,content,current_"
-            "user_can_delete,current_user_can_view,current_user_has_liked,embe"
-            "d,image,is_paid,like_count,min_cents_pledged_to_view,post_file,pu"
-            "blished_at,patron_count,patreon_url,post_type,pledge_url,thumbnai"
-            "l_url,teaser_text,title,upgrade_url,url,was_posted_by_campaign_ow"
-            "ner"
-            "&fields[user]=image_url,full_name,url"
-            "&fields[campaign]=avatar_photo_url,earnings_visibility,is_nsfw,is"
-            "_monthly,name,url"
-            "&fields[access_rule]=access_rule_type,amount_cents" + query +
-
-            "&json-api-use-default-includes=false"
-            "&json-api-version=1.0"
-        )
+        return API_URL_FMT.format(endpoint, query)
+
+
+class IncludedIndex(dict):
+    """Map (type, id) pairs of 'included' objects to their attributes
+
+    The index gets built lazily: 'included' is only scanned as far as
+    necessary to find a requested entry.
+    """
+
+    def __init__(self, included):
+        dict.__init__(self)
+        self.included = iter(included)
+
+    def __missing__(self, key):
+        for inc in self.included:
+            ikey = (inc["type"], inc["id"])
+            attr = self[ikey] = inc["attributes"]
+            if ikey == key:
+                return attr
+        raise KeyError(key)
 
 
 class PatreonCreatorExtractor(PatreonExtractor):
@@ -191,7 +295,10 @@ class PatreonCreatorExtractor(PatreonExtractor):
     def posts(self):
         url = "{}/{}".format(self.root, self.creator)
         page = self.request(url).text
-        campaign_id = text.extract(page, "/campaign/", "/")[0]
+        match = CAMPAIGN_RE.search(page)
+        if not match:
+            raise exception.NotFoundError("creator")
+        campaign_id = match.group(1)
 
         url = self._build_url("posts", (
             "&sort=-published_at"
@@ -232,8 +339,10 @@ class PatreonPostExtractor(PatreonExtractor):
     def posts(self):
         url = "{}/posts/{}".format(self.root, self.post_id)
         page = self.request(url).text
-        data = text.extract(page, "window.patreon.bootstrap,", "\n});")[0]
-        post = json.loads(data + "}")["post"]
+        match = BOOTSTRAP_RE.search(page)
+        if not match:
+            raise exception.NotFoundError("post")
+        post = json.JSONDecoder().raw_decode(page, match.end())[0]["post"]
 
-        included = self._transform(post["included"])
+        included = IncludedIndex(post["included"])
         return (self._process(post["data"], included),)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Mike Fährmann
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+
+import unittest
+
+from gallery_dl.cache import memcache
+
+
+class TestMemcache(unittest.TestCase):
+
+    def test_keyarg(self):
+
+        class Cls():
+            calls = []
+
+            @memcache(keyarg=1)
+            def func(self, key, value):
+                self.calls.append(key)
+                return value
+
+        obj1 = Cls()
+        obj2 = Cls()
+
+        self.assertEqual(obj1.func("a", 1), 1)
+        self.assertEqual(obj1.func("a", 2), 1)
+        self.assertEqual(obj1.func("b", 3), 3)
+        # the cache is shared between instances
+        self.assertEqual(obj2.func("a", 4), 1)
+        self.assertEqual(obj2.func("b", 5), 3)
+        self.assertEqual(obj2.func("c", 6), 6)
+        self.assertEqual(Cls.calls, ["a", "b", "c"])
+
+    def test_no_keyarg(self):
+
+        class Cls():
+
+            @memcache()
+            def func(self, value):
+                return value
+
+        obj = Cls()
+        self.assertEqual(obj.func(1), 1)
+        self.assertEqual(obj.func(2), 1)
+        self.assertEqual(Cls().func(3), 1)
+
+    def test_maxage(self):
+
+        @memcache(maxage=-1, keyarg=0)
+        def func(key, value):
+            return value
+
+        self.assertEqual(func("a", 1), 1)
+        self.assertEqual(func("a", 2), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
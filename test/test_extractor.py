@@ -182,5 +182,29 @@ class TestExtractor(unittest.TestCase):
                 self.assertEqual(expected, extr.__name__)
 
 
+class TestPatreon(unittest.TestCase):
+
+    def test_nameext(self):
+        from gallery_dl.extractor.patreon import _nameext
+        from gallery_dl import text
+
+        names = (
+            "", "name", "name.ext", "Name 01.JPG", "name.tar.gz", ".ext",
+            "..ext", "name.", "a\\b.png", "n\u00e4me.png",
+            # URL-specific characters
+            "a/b.png", "a?b.png", "a#b.png", "a%20b.png", "a:b.png",
+            "a\tb.png", "a\nb.png", " name.png", "\x00name.png",
+            "https://example.org/path/file.png?q=1#frag",
+            # non-string values
+            None, 1, [],
+        )
+        for name in names:
+            self.assertEqual(
+                _nameext(name, {}),
+                text.nameext_from_url(name, {}),
+                repr(name),
+            )
+
+
 if __name__ == "__main__":
     unittest.main()